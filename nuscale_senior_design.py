@@ -1,6 +1,135 @@
 import radioactivedecay as rd
-import json as json
+import functools
 import math as math
+import pathlib
+import numpy as np
+from scipy.linalg.blas import dtrmv
+from radioactivedecay.converters import UnitConverterFloat
+
+NUCLIDES_JSON = pathlib.Path('radioactivedecay/nuscale_senior_design/nuclides.json')
+GAMMA_TABLES_NPZ = NUCLIDES_JSON.with_name('gamma_tables.npz')
+
+try:
+    from orjson import loads as json_loads
+except ImportError: # json.loads also accepts bytes
+    from json import loads as json_loads
+
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError: # run the stepping loop as plain Python if Numba is not installed
+    HAVE_NUMBA = False
+    prange = range
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
+@functools.lru_cache(maxsize=None)
+def load_gamma_tables():
+    """
+    Returns the pre-binned gamma lines of every nuclide in nuclides.json as a dict of NumPy
+    arrays: 'nuclides', the 'bins' and 'gammas' (intensities) of every line, and the 'offsets'
+    of each nuclide's lines. The arrays are cached in gamma_tables.npz, which is rebuilt
+    whenever nuclides.json is newer.
+    """
+
+    if (not GAMMA_TABLES_NPZ.exists()
+            or GAMMA_TABLES_NPZ.stat().st_mtime < NUCLIDES_JSON.stat().st_mtime):
+        nuclide_data = json_loads(NUCLIDES_JSON.read_bytes())
+        energies, gammas, lines_per_nuclide = [], [], []
+        for nuclide in nuclide_data:
+            nuclide_gammas = nuclide_data[nuclide]['gammas']
+            energies.extend(nuclide_gammas)
+            gammas.extend(nuclide_gammas.values())
+            lines_per_nuclide.append(len(nuclide_gammas))
+        # Parse every energy key (MeV) in one pass and bin them together
+        energies = np.fromiter(map(float, energies), dtype=np.float64, count=len(energies))
+        np.savez(
+            GAMMA_TABLES_NPZ,
+            nuclides=np.array(list(nuclide_data)),
+            bins=np.minimum(energies.astype(np.int64), 5).astype(np.int8),
+            gammas=np.array(gammas, dtype=np.float64),
+            offsets=np.concatenate(([0], np.cumsum(lines_per_nuclide))),
+        )
+    with np.load(GAMMA_TABLES_NPZ) as tables:
+        return {name: tables[name] for name in tables.files}
+
+
+if HAVE_NUMBA:
+    @njit(cache=True, fastmath=True)
+    def tril_matvec_add(M, N, src, out):
+        """
+        Sets out = M N + src, reading only the lower triangle of M.
+        """
+
+        for i in range(M.shape[0]):
+            acc = src[i]
+            for j in range(i + 1):
+                acc += M[i, j] * N[j]
+            out[i] = acc
+else:
+    def tril_matvec_add(M, N, src, out):
+        """
+        Sets out = M N + src, using BLAS dtrmv (M.T is the Fortran-ordered upper triangle).
+        """
+
+        np.add(dtrmv(M.T, N, lower=0, trans=1), src, out=out)
+
+if HAVE_NUMBA:
+    @njit(cache=True, fastmath=True)
+    def bin_lines(activities, flat_bins, flat_g, line_to_nuc, bins):
+        """
+        Adds the activity-weighted intensity of every gamma line to its energy bin.
+        """
+
+        for k in range(flat_g.size):
+            bins[flat_bins[k]] += activities[line_to_nuc[k]] * flat_g[k]
+else:
+    def bin_lines(activities, flat_bins, flat_g, line_to_nuc, bins):
+        """
+        Adds the activity-weighted intensity of every gamma line to its energy bin, as one
+        NumPy scatter-add rather than a Python loop over the lines.
+        """
+
+        bins += np.bincount(
+            flat_bins, weights=activities[line_to_nuc] * flat_g, minlength=bins.size
+        )
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def run(M, Mx, src, flat_bins, flat_g, line_to_nuc, decay_consts, steps, x):
+    """
+    Steps the inventory N -> M (N + src), with M lower triangular, and records the gamma bins
+    and the nuclide activities every x steps. Mx is the decay matrix for x steps (M^x), so
+    consecutive samples are related by N -> Mx N + Sx, where Sx is the inventory built up
+    from the source over x steps. Returns the (rows, 6) bins time series and the
+    (rows, nuclides) activities.
+    """
+
+    n_rows = (steps - 1) // x + 1
+    n = M.shape[0]
+    src_decayed = M @ src # M (N + src) == M N + M src
+    Sx = np.zeros(n)
+    Sx_next = np.empty(n) # preallocated output buffer for the mat-vec
+    for _ in range(x):
+        tril_matvec_add(M, Sx, src_decayed, Sx_next) # one unit of desired time step
+        Sx, Sx_next = Sx_next, Sx
+
+    # Row r is sampled after r * x + 1 steps; the recurrence over rows is sequential
+    states = np.empty((n_rows, n))
+    states[0, :] = src_decayed
+    for row in range(1, n_rows):
+        tril_matvec_add(Mx, states[row - 1], Sx, states[row])
+
+    # The state N stays in float64; the recorded outputs only need float32
+    bins_ts = np.zeros((n_rows, 6), dtype=np.float32)
+    contrib_ts = np.zeros((n_rows, n), dtype=np.float32)
+    for row in prange(n_rows):
+        activities = states[row] * decay_consts
+        contrib_ts[row, :] = activities
+        bin_lines(activities, flat_bins, flat_g, line_to_nuc, bins_ts[row])
+    return bins_ts, contrib_ts
+
 
 source = {
 'Kr-85': 8.07E+06,
@@ -81,61 +210,68 @@ for nuclide in source:
 
 print(total_output)
 
-decayed = rd.Inventory({}, "Bq")
-with open('radioactivedecay/nuscale_senior_design/nuclides.json') as nuclides_json:
-    nuclide_data = json.load(nuclides_json)
-    output = 'Time,Bin 1,Bin 2,Bin 3,Bin 4,Bin 5,Bin 6\n'
-    contributions = []
-    nuclide_list = set([])
-    i = 0
-    rows = -1
-    x = math.floor(steps / output_rows)
-    while i < steps: # maximum number of steps
-        bins = [0, 0, 0, 0, 0, 0]
-        if i % x == 0:
-            contributions.append({})
-            rows += 1
-            print(rows);
-        decayed.add(source_per_timestep, 'Bq')
-        decayed = decayed.decay(1, timestep) # one unit of desired time step
-        numbers = decayed.activities()
-        for nuclide in numbers.keys():
-            nuclide_list.add(nuclide)
-            gammas = nuclide_data[nuclide]['gammas']
-            if i % x == 0:
-                contributions[rows][nuclide] = numbers[nuclide]
-            for energy in gammas.keys():
-                e = float(energy)
-                c = numbers[nuclide] * gammas[energy]
-                if e < 1:
-                    bins[0] += c
-                elif e < 2:
-                    bins[1] += c
-                elif e < 3:
-                    bins[2] += c
-                elif e < 4:
-                    bins[3] += c
-                elif e < 5:
-                    bins[4] += c
-                else:
-                    bins[5] += c
-        if i % x == 0:
-            output += str(i) + ','
-            output += ','.join(map(str, bins))
-            output += '\n'
-            with open('decay.csv', 'w') as csv:
-                csv.write(output)
-        i += 1
-    with open('nuclide_contributions.csv', 'w') as nuclides_csv:
-        contrib_output = ''
-        for nuclide in nuclide_list:
-            contrib_output += nuclide + ','
-        contrib_output += '\n'
-        for step in contributions:
-            for nuclide in nuclide_list:
-                if nuclide in step:
-                    contrib_output += str(step[nuclide]) + ','
-                else:
-                    contrib_output += '0,'
-            contrib_output += '\n'
-        nuclides_csv.write(contrib_output)
+# Decay matrices C e^{Lambda t} C^-1 are restricted to the source nuclides and their progeny.
+# Ordering by dataset index keeps them lower triangular.
+decay_data = rd.DEFAULTDATA
+matrices = decay_data.scipy_data
+indices_set = set()
+for nuclide in source_per_timestep:
+    indices_set.update(matrices.matrix_c[:, decay_data.nuclide_dict[nuclide]].nonzero()[0])
+indices = sorted(indices_set)
+nuclide_names = list(decay_data.nuclides[indices])
+decay_consts = matrices.decay_consts[indices]
+matrix_c = matrices.matrix_c[indices, :][:, indices]
+matrix_c_inv = matrices.matrix_c_inv[indices, :][:, indices]
+
+
+def decay_matrix(decay_time):
+    """
+    Returns the dense decay matrix of the tracked nuclides for decay_time seconds.
+    """
+
+    return np.ascontiguousarray(
+        matrix_c @ np.diag(np.exp(-decay_time * decay_consts)) @ matrix_c_inv
+    )
+
+
+decay_time = UnitConverterFloat.time_unit_conv(1, timestep, 's', decay_data.float_year_conv)
+x = math.floor(steps / output_rows)
+M = decay_matrix(decay_time) # one step
+Mx = decay_matrix(x * decay_time) # M^x, x steps between output rows
+
+# Source activities (Bq) converted to numbers of atoms
+source_activities = np.array([source_per_timestep.get(nuclide, 0.0) for nuclide in nuclide_names])
+source_vec = np.divide(
+    source_activities, decay_consts, out=np.zeros_like(source_activities), where=source_activities > 0
+)
+
+# Gather the gamma lines of the tracked nuclides into one table for the stepping loop
+gamma_tables = load_gamma_tables()
+offsets = gamma_tables['offsets']
+table_idx = {nuclide: j for j, nuclide in enumerate(gamma_tables['nuclides'])}
+line_slices = [
+    slice(offsets[table_idx[nuclide]], offsets[table_idx[nuclide] + 1]) for nuclide in nuclide_names
+]
+flat_bins = np.concatenate([gamma_tables['bins'][lines] for lines in line_slices])
+flat_gammas = np.concatenate(
+    [gamma_tables['gammas'][lines] for lines in line_slices]
+).astype(np.float32)
+nuclide_of_line = np.repeat(
+    np.arange(len(nuclide_names)), [lines.stop - lines.start for lines in line_slices]
+)
+
+bins_ts, contrib_ts = run(
+    M, Mx, source_vec, flat_bins, flat_gammas, nuclide_of_line, decay_consts, int(steps), x
+)
+
+decay_ts = np.zeros((len(bins_ts), 7))
+decay_ts[:, 0] = np.arange(len(bins_ts)) * x # time step of each row
+decay_ts[:, 1:] = bins_ts
+np.savetxt(
+    'decay.csv', decay_ts, fmt=['%d'] + ['%.9g'] * 6, delimiter=',',
+    header='Time,Bin 1,Bin 2,Bin 3,Bin 4,Bin 5,Bin 6', comments=''
+)
+np.savetxt(
+    'nuclide_contributions.csv', contrib_ts, fmt='%.9g', delimiter=',',
+    header=','.join(nuclide_names), comments=''
+)